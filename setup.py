@@ -22,9 +22,9 @@ setuptools.setup(
     ],
     install_requires=[
         "zeroconf",
-        "requests",
-        "uuid",
-        "pillow",
-        "imagehash"
+        "requests>=2.27",
+        "urllib3>=2.2",
+        "orjson",
+        "uuid"
     ],
 )
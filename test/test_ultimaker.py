@@ -1,12 +1,20 @@
 import unittest
-from unittest.mock import Mock, patch
+import asyncio
+from unittest.mock import MagicMock, Mock, patch
 import json
-from ultimaker import Printer, Credentials, Identity, PrintJob
+from ultimaker import Printer, Credentials, Identity, PrintJob, gather_ultimaker_jsons
+from ultimaker.api import data_uri, parse_ultimaker_datetime, _mjpeg_frames, SNAPSHOT_CHUNK_SIZE, ULTIMAKER_DATETIME_FORMAT
+import base64
 from uuid import UUID, uuid4
 import os
-from datetime import timedelta
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from datetime import datetime, timedelta
 from typing import Dict
 import requests
+import urllib3
 
 mock_identity: str = Identity('mock application', 'mock user')
 mock_name: str = '2D Printer'
@@ -137,6 +145,21 @@ class UltimakerJsonTest(unittest.TestCase):
             }
         }, json)
 
+    def test_polls_reuse_the_printer_worker_threads(self):
+        printer = default_printer_mock()
+        printer.get_camera_snapshot_uri = Mock(return_value=mock_camera_snapshot_uri)
+        status_threads = set()
+
+        def get_printer_status():
+            status_threads.add(threading.current_thread())
+            return 'idle'
+        printer.get_printer_status = get_printer_status
+
+        for _ in range(3):
+            printer.into_ultimaker_json()
+        self.assertTrue(status_threads <= set(printer._executor._threads))
+        printer.close()
+
     def test_expected_json_is_produced_when_timeout(self):
         printer = default_printer_mock()
         printer.get_credentials = Mock(return_value=mock_credentials)
@@ -184,24 +207,277 @@ class UltimakerJsonTest(unittest.TestCase):
         }, json)
 
 
+class GatherUltimakerJsonsTest(unittest.TestCase):
+    def test_each_printer_gets_its_own_result(self):
+        idle_printer = default_printer_mock()
+        idle_printer.get_camera_snapshot_uri = Mock(return_value=mock_camera_snapshot_uri)
+        failing_printer = default_printer_mock()
+        failing_printer.get_printer_status = generic_exception_raiser
+        failing_printer.get_camera_snapshot_uri = Mock(return_value=mock_camera_snapshot_uri)
+
+        idle_json, failure = asyncio.run(gather_ultimaker_jsons([idle_printer, failing_printer]))
+        self.assertEqual({'status': 'idle'}, idle_json['printer'])
+        self.assertIsInstance(failure, requests.exceptions.RequestException)
+
+    def test_printers_are_polled_at_the_same_time(self):
+        # Every blocking call waits until all of them, 3 for each of the 4 printers, are running at once
+        barrier = threading.Barrier(12, timeout=5)
+
+        def after_barrier(value):
+            def wait():
+                barrier.wait()
+                return value
+            return Mock(side_effect=wait)
+
+        printers = []
+        for _ in range(4):
+            printer = default_printer_mock()
+            printer.get_printer_status = after_barrier('idle')
+            printer.get_system_name = after_barrier(mock_name)
+            printer.get_camera_snapshot_uri = after_barrier(mock_camera_snapshot_uri)
+            printers.append(printer)
+
+        results = asyncio.run(gather_ultimaker_jsons(printers))
+        self.assertEqual([{'status': 'idle'}] * 4, [result['printer'] for result in results])
+        for printer in printers:
+            printer.close()
+
+    def test_batch_uses_a_given_executor(self):
+        printer = default_printer_mock()
+        printer.get_camera_snapshot_uri = Mock(return_value=mock_camera_snapshot_uri)
+        executor = Mock(wraps=ThreadPoolExecutor(max_workers=1))
+        asyncio.run(gather_ultimaker_jsons([printer], executor))
+        executor.submit.assert_called()
+        executor.shutdown()
+        printer.close()
+
+
 def generic_exception_raiser():
     raise requests.exceptions.RequestException('An exception has occurred')
 
 def timeout_exception_raiser():
     raise requests.exceptions.Timeout('An exception has occurred')
 
-class VerifiesLoadedCredentialsTest(unittest.TestCase):
+class ReacquiresRejectedCredentialsTest(unittest.TestCase):
     def setUp(self):
         printer = default_printer_mock()
+        printer.get_printer_status = Printer.get_printer_status.__get__(printer)
+        printer._session = Mock()
         self.printer = printer
-        self.printer.get_auth_verify = Mock(return_value=False)
 
-    def test_printer_is_not_verified(self):
-        self.assertFalse(self.printer.credentials is None)
-        self.printer.get_credentials()
-        self.assertTrue(self.printer.credentials is not None)
+    def test_loaded_credentials_are_not_verified_up_front(self):
+        self.printer._session.request.return_value = Mock(status_code=200, content=b'"idle"')
+        self.assertEqual('idle', self.printer.get_printer_status())
+        self.printer._session.request.assert_called_once()
+        self.printer.get_auth_verify.assert_not_called()
+        self.printer.post_auth_request.assert_not_called()
+
+    def test_printer_reacquires_credentials_on_401(self):
+        self.printer._session.request.side_effect = [
+            Mock(status_code=401, content=b''),
+            Mock(status_code=200, content=b'"idle"'),
+        ]
+        self.assertEqual('idle', self.printer.get_printer_status())
+        self.assertEqual(2, self.printer._session.request.call_count)
         self.printer.post_auth_request.assert_called_once()
-        self.printer.get_auth_verify.assert_called_once()
+        self.printer.get_auth_verify.assert_not_called()
+
+    def test_printer_reuses_digest_auth(self):
+        self.assertIs(self.printer.digest_auth(), self.printer.digest_auth())
+
+
+class MemoizesSystemInfoTest(unittest.TestCase):
+    def test_system_name_is_requested_only_once(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer._session = Mock()
+        printer._session.get.return_value.content = json.dumps(mock_name).encode()
+        self.assertEqual(mock_name, printer.get_system_name())
+        self.assertEqual(mock_name, printer.get_system_name())
+        printer._session.get.assert_called_once()
+
+
+class DataUriTest(unittest.TestCase):
+    def test_chunked_encoding_matches_base64(self):
+        content = bytes(range(256)) * (SNAPSHOT_CHUNK_SIZE // 100)
+        self.assertEqual(
+            f"data:image/jpeg;base64,{base64.b64encode(content).decode('ascii')}",
+            data_uri('image/jpeg', content))
+
+
+class ParseUltimakerDatetimeTest(unittest.TestCase):
+    def test_matches_strptime(self):
+        for value in ['2018-10-10T00:46:40.776Z', '2019-09-17T18:01:32.1Z', '2019-09-17T18:01:32.123456Z']:
+            self.assertEqual(datetime.strptime(value, ULTIMAKER_DATETIME_FORMAT), parse_ultimaker_datetime(value))
+
+    def test_rejects_other_formats(self):
+        for value in ['2019-09-17T18:01:32', '2018-10-10X00:46:40.776Z', '+018-10-10T00:46:40.776Z',
+                      '2018 10 10T00:46:40. 77Z', '2018-10-10T00:46:40.-77Z', '2018-10-10T00:46:40.1234567Z']:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    datetime.strptime(value, ULTIMAKER_DATETIME_FORMAT)
+                with self.assertRaises(ValueError):
+                    parse_ultimaker_datetime(value)
+
+
+mock_print_job_dict: Dict = {
+    "time_elapsed": 30,
+    "time_total": 60,
+    "datetime_started": "2019-09-17T18:01:32.123Z",
+    "datetime_finished": "2019-09-17T18:02:32.5Z",
+    "datetime_cleaned": "2019-09-17T18:03:32.000Z",
+    "source": "WEB_API",
+    "source_user": "U2",
+    "source_application": "Cura Connect",
+    "name": mock_print_job_name,
+    "uuid": "1c6a3f1e-43f1-4c4c-8f4b-fb5f4b2a9c11",
+    "reprint_original_uuid": "6f2a2f5a-2e83-4b71-9a3d-7ba1e3c1f7a2",
+    "state": mock_print_job_state,
+    "progress": mock_print_job_progress,
+    "pause_source": "",
+    "result": "",
+}
+
+
+class PrintJobParseTest(unittest.TestCase):
+    def test_fields_are_converted(self):
+        print_job = PrintJob.parse(mock_print_job_dict)
+        self.assertEqual(mock_print_job_time_elapsed, print_job.time_elapsed)
+        self.assertEqual(mock_print_job_time_total, print_job.time_total)
+        self.assertEqual(datetime(2019, 9, 17, 18, 1, 32, 123000), print_job.datetime_started)
+        self.assertEqual(datetime(2019, 9, 17, 18, 2, 32, 500000), print_job.datetime_finished)
+        self.assertEqual(UUID(mock_print_job_dict['uuid']), print_job.uuid)
+        self.assertEqual(mock_print_job_progress, print_job.progress)
+        self.assertEqual(mock_print_job_state, print_job.state)
+
+    def test_unknown_fields_are_ignored(self):
+        print_job = PrintJob.parse({**mock_print_job_dict, 'unknown_field': 'value'})
+        self.assertEqual(PrintJob.parse(mock_print_job_dict), print_job)
+
+
+class PersistsToStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = shelve.open(os.path.join(self.directory.name, 'printers'))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_printer_loads_what_an_earlier_printer_stored(self):
+        printer = Printer(mock_address, mock_port, mock_identity, store=self.store)
+        printer._session = Mock()
+        printer._session.get.return_value.content = json.dumps(mock_name).encode()
+        printer.set_credentials(mock_credentials)
+        printer.get_system_name()
+
+        restarted = Printer(mock_address, mock_port, mock_identity, store=self.store)
+        self.assertEqual(mock_credentials, restarted.credentials)
+        self.assertEqual(mock_name, restarted.name)
+        self.assertIsNone(restarted.guid)
+
+    def test_printer_only_writes_changes(self):
+        Printer(mock_address, mock_port, mock_identity, store=self.store)
+        self.assertNotIn(f'{mock_address}/{mock_identity.application}/{mock_identity.user}', self.store)
+
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials, store=self.store)
+        with patch.object(self.store, 'sync') as sync:
+            printer.set_credentials(mock_credentials)
+        sync.assert_not_called()
+
+
+class JsonResponseTest(unittest.TestCase):
+    def test_invalid_json_is_a_request_exception(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer._session = Mock()
+        printer._session.get.return_value.content = b'<html>Not Found</html>'
+        with self.assertRaises(requests.exceptions.RequestException):
+            printer.get_system_name()
+
+
+class RequestTimeoutTest(unittest.TestCase):
+    def test_connect_and_read_timeouts_are_applied(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials, timeout=0.5, connect_timeout=0.1)
+        with patch.object(requests.Session, 'request') as request:
+            printer._session.get('http://127.0.0.1')
+        self.assertEqual((0.1, 0.5), request.call_args[1]['timeout'])
+
+    def test_changed_timeouts_are_applied(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer.timeout = 2.0
+        printer.connect_timeout = 1.0
+        with patch.object(requests.Session, 'request') as request:
+            printer._session.get('http://127.0.0.1')
+        self.assertEqual((1.0, 2.0), request.call_args[1]['timeout'])
+
+
+class MjpegFramesTest(unittest.TestCase):
+    def test_frames_are_split_on_boundary(self):
+        stream = (
+            b'--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 3\r\n\r\nabc\r\n'
+            b'--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 2\r\nX-Timestamp: 1.5\r\n\r\nde\r\n'
+            b'--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 10\r\n\r\ntrunc')
+        for chunk_size in [1, 7, len(stream)]:
+            chunks = [stream[start:start + chunk_size] for start in range(0, len(stream), chunk_size)]
+            self.assertEqual([('image/jpeg', b'abc'), ('image/jpeg', b'de')],
+                             list(_mjpeg_frames(chunks, b'boundarydonotcross')))
+
+    def test_frame_is_yielded_before_the_next_chunk_arrives(self):
+        def chunks():
+            yield b'--b\r\nContent-Type: image/jpeg\r\nContent-Length: 3\r\n\r\nabc'
+            raise AssertionError('read past the end of the first frame')
+        self.assertEqual(('image/jpeg', b'abc'), next(_mjpeg_frames(chunks(), b'b')))
+
+    def test_stream_reader_clears_frame_when_stream_stalls(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer._session = Mock()
+        res = MagicMock()
+        res.__enter__.return_value = res
+        res.headers = {'Content-Type': 'multipart/x-mixed-replace;boundary=b'}
+        published_frames = []
+        chunks = iter([b'--b\r\nContent-Type: image/jpeg\r\nContent-Length: 1\r\n\r\nA\r\n'])
+
+        def read1(amt):
+            for chunk in chunks:
+                return chunk
+            # The printer stops sending without closing the connection
+            published_frames.append(printer._latest_frame)
+            raise urllib3.exceptions.ReadTimeoutError(None, None, 'Read timed out.')
+        res.raw.read1.side_effect = read1
+
+        responses = iter([res])
+
+        def get(**kwargs):
+            for response in responses:
+                return response
+            # The stalled stream must have been dropped rather than left as the latest frame
+            published_frames.append(printer._latest_frame)
+            printer._camera_stream_stop.set()
+            raise requests.exceptions.ConnectionError('Printer is gone')
+        printer._session.get.side_effect = get
+
+        with patch('ultimaker.api.CAMERA_STREAM_RETRY_INTERVAL', 0):
+            printer._read_camera_stream()
+        self.assertEqual(('image/jpeg', b'A'), published_frames[0][:2])
+        self.assertIsNone(published_frames[1])
+        self.assertIsNone(printer._latest_frame)
+
+    def test_snapshot_uses_latest_stream_frame(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer._session = Mock()
+        printer._latest_frame = ('image/jpeg', b'frame', b'digest')
+        self.assertEqual(('image/jpeg', b'frame', b'digest'), printer.get_camera_frame())
+        printer._session.get.assert_not_called()
+
+    def test_snapshot_uri_follows_frame_changes(self):
+        printer = Printer(mock_address, mock_port, mock_identity, mock_credentials)
+        printer._session = Mock()
+        printer._latest_frame = ('image/jpeg', b'first', b'1')
+        first_uri = printer.get_camera_snapshot_uri()
+        self.assertEqual(data_uri('image/jpeg', b'first'), first_uri)
+        printer._latest_frame = ('image/jpeg', b'second', b'2')
+        self.assertEqual(data_uri('image/jpeg', b'second'), printer.get_camera_snapshot_uri())
+        printer._latest_frame = ('image/jpeg', b'first', b'1')
+        self.assertIs(first_uri, printer.get_camera_snapshot_uri())
 
 
 if __name__ == '__main__':
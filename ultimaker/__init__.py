@@ -1,3 +1,3 @@
-from .api import Identity, Credentials, Printer, PrintJob
+from .api import Identity, Credentials, Printer, PrintJob, gather_ultimaker_jsons
 
 __version__ = '0.0.7'
@@ -1,18 +1,23 @@
 from typing import NamedTuple
 from collections import OrderedDict
-from typing import Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 import json
 import datetime
+import asyncio
+import functools
 import base64
-import io
+import hashlib
 import shelve
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
 
 from zeroconf import ServiceInfo
+import orjson
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 from uuid import UUID
-from PIL import Image
-import imagehash
 
 
 # The mDNS response looks like this:
@@ -49,6 +54,132 @@ class Identity(NamedTuple):
 
 ULTIMAKER_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
+
+# The separators of ULTIMAKER_DATETIME_FORMAT by position, e.g. 2018-10-10T00:46:40.776Z
+_DATETIME_SEPARATORS = ((4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':'), (19, '.'))
+
+
+# A stricter, zero-padded-only version of datetime.datetime.strptime(value, ULTIMAKER_DATETIME_FORMAT). The fixed
+# layout the firmware sends is sliced directly instead of going through strptime's regex and locale machinery.
+# Unlike strptime, it rejects fields that aren't zero-padded (e.g. '2018-10- 5T00:46:4.9Z') and non-ASCII digits.
+def parse_ultimaker_datetime(value: str) -> datetime.datetime:
+    # int() would also accept signs and whitespace, so every field is checked to be plain digits first
+    digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19] + value[20:-1]
+    if (not 22 <= len(value) <= 27 or value[-1] != 'Z'
+            or any(value[index] != separator for index, separator in _DATETIME_SEPARATORS)
+            or not (digits.isascii() and digits.isdigit())):
+        raise ValueError(f"time data {value!r} does not match format {ULTIMAKER_DATETIME_FORMAT!r}")
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+        int(value[20:-1].ljust(6, '0')))
+
+
+# Snapshots are read and base64 encoded in chunks of this many bytes. It is a multiple of 3 so the encoded
+# chunks concatenate without padding in between.
+SNAPSHOT_CHUNK_SIZE = 57 * 1024
+
+
+def data_uri(content_type: str, content: bytes) -> str:
+    uri = bytearray(f'data:{content_type};base64,'.encode('ascii'))
+    view = memoryview(content)
+    for start in range(0, len(view), SNAPSHOT_CHUNK_SIZE):
+        uri += base64.b64encode(view[start:start + SNAPSHOT_CHUNK_SIZE])
+    # base64 output is pure ASCII
+    return uri.decode('ascii')
+
+
+def _snapshot_digest(content: bytes) -> bytes:
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+# Yields (content type, frame) for each part of a multipart/x-mixed-replace stream as served by MJPG-streamer:
+#   --boundarydonotcross
+#   Content-Type: image/jpeg
+#   Content-Length: 45903
+#   X-Timestamp: 1539132400.776
+#
+#   <JPEG bytes>
+# chunks may split the stream anywhere. A frame is yielded as soon as its last byte has arrived.
+def _mjpeg_frames(chunks: Iterable[bytes], boundary: bytes) -> Iterator[Tuple[str, bytes]]:
+    delimiter = b'--' + boundary
+    chunks = iter(chunks)
+    buffer = bytearray()
+
+    def fill() -> bool:
+        chunk = next(chunks, b'')
+        buffer.extend(chunk)
+        return bool(chunk)
+
+    while True:
+        end = buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if not fill():
+                return
+            continue
+        lines = [line.strip() for line in bytes(buffer[:end]).split(b'\r\n')]
+        del buffer[:end + 4]
+        if delimiter not in lines:
+            continue
+        headers: Dict[bytes, bytes] = {}
+        for line in lines[lines.index(delimiter) + 1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+        if b'content-length' not in headers:
+            continue
+        length = int(headers[b'content-length'])
+        while len(buffer) < length:
+            if not fill():
+                return
+        frame = bytes(buffer[:length])
+        del buffer[:length]
+        yield headers.get(b'content-type', b'image/jpeg').decode('ascii'), frame
+
+
+# Yields data from a streamed response as soon as it arrives. Unlike iter_content, read1 (urllib3 2.2+) doesn't wait for a
+# full chunk (or, with chunk_size=None, the end of a non-chunked body), so no frame lags behind the stream.
+def _available_chunks(raw: urllib3.response.HTTPResponse) -> Iterator[bytes]:
+    while True:
+        chunk = raw.read1(SNAPSHOT_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+# orjson parses response bodies considerably faster than the json module behind requests.Response.json.
+# Decode errors are raised as requests' JSONDecodeError, like Response.json does, so they remain RequestExceptions.
+def _json(response: requests.Response):
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos, response=response) from e
+
+
+class _TimeoutSession(requests.Session):
+    '''A session that applies a (connect, read) timeout to every request that doesn't set one itself'''
+
+    # timeouts is called for each request, so changes to the owner's timeouts take effect immediately
+    def __init__(self, timeouts: Callable[[], Tuple[float, float]]):
+        super().__init__()
+        self.timeouts = timeouts
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeouts())
+        return super().request(method, url, **kwargs)
+
+
+# Stores may be shared by many printers polled from different threads, and shelve/dbm isn't thread-safe
+_STORE_LOCK = threading.Lock()
+
+# Number of blocking requests into_ultimaker_json_async has in flight at once
+_CONCURRENT_REQUESTS_PER_PRINTER = 3
+
+# Number of recently seen camera frames whose data URI is kept, keyed by frame digest
+CAMERA_URI_CACHE_SIZE = 8
+
+# Seconds to wait before reconnecting after the camera stream drops
+CAMERA_STREAM_RETRY_INTERVAL = 1.0
+
 # {
 #   "time_elapsed": 0,
 #   "time_total": 0,
@@ -82,70 +213,153 @@ class PrintJob(NamedTuple):
 
     @classmethod
     def parse(cls: 'PrintJob', dct: Dict) -> 'PrintJob':
-        print_job_dict = {}
-        for field, value in dct.items():
-            if field.startswith('time'):
-                print_job_dict[field] = datetime.timedelta(seconds=value)
-            elif field.startswith('datetime'):
-                print_job_dict[field] = datetime.datetime.strptime(dct[field], ULTIMAKER_DATETIME_FORMAT)
-            else: # Typecast
-                print_job_dict[field] = cls.__annotations__[field](value)
-        return PrintJob(**print_job_dict)
-    
+        return cls._make([convert(dct[field]) for field, convert in cls._converters])
+
     def as_str_dict(self) -> Dict[str, str]:
         return {field: str(value) for field, value in self._asdict().items()}
 
 
+def _field_converter(field: str, annotation: type):
+    if field.startswith('time'):
+        return lambda value: datetime.timedelta(seconds=value)
+    elif field.startswith('datetime'):
+        return parse_ultimaker_datetime
+    else: # Typecast
+        return annotation
+
+
+# Resolved once here so PrintJob.parse doesn't have to dispatch on each field's name for every print job.
+# The (field, converter) pairs are in tuple order, so parse can build the PrintJob in one pass.
+PrintJob._converters = tuple(
+    (field, _field_converter(field, PrintJob.__annotations__[field])) for field in PrintJob._fields)
+
+
 class Printer():
-    def __init__(self, address: str, port: int, identity: Identity, credentials: Credentials = None, timeout: float = 0.75):
+    # timeout is the read timeout. Connecting gets the shorter connect_timeout, so an offline printer fails fast on a LAN.
+    # If a store is given, credentials, guid and name are remembered in it across restarts, keyed by address and identity.
+    def __init__(self, address: str, port: int, identity: Identity, credentials: Credentials = None, timeout: float = 0.75, connect_timeout: float = 0.2, store: shelve.Shelf = None):
         self.address = address
         self.host = f'{address}:{port}'
         self.identity = identity
-        self.credentials = credentials
         self.timeout = timeout
-        self.name = None
-        self.guid = None
+        self.connect_timeout = connect_timeout
+        # Built once rather than formatted on every request
+        api = f'http://{self.host}/api/v1'
+        camera = f'http://{address}:8080'
+        self._urls = {
+            'auth_request': f'{api}/auth/request',
+            # The credentials id is appended per request
+            'auth_check': f'{api}/auth/check/',
+            'auth_verify': f'{api}/auth/verify',
+            'printer_status': f'{api}/printer/status',
+            'print_job': f'{api}/print_job',
+            'print_job_state': f'{api}/print_job/state',
+            'print_job_time_elapsed': f'{api}/print_job/time_elapsed',
+            'print_job_time_total': f'{api}/print_job/time_total',
+            'print_job_progress': f'{api}/print_job/progress',
+            'print_job_name': f'{api}/print_job/name',
+            'system_display_message': f'{api}/system/display_message',
+            'beep': f'{api}/beep',
+            'system_guid': f'{api}/system/guid',
+            'system_name': f'{api}/system/name',
+            'camera_snapshot': f'{camera}/?action=snapshot',
+            'camera_stream': f'{camera}/?action=stream',
+        }
+        self._store = store
+        self._store_key = f'{address}/{identity.application}/{identity.user}'
+        stored: Dict = {}
+        if store is not None:
+            with _STORE_LOCK:
+                stored = store.get(self._store_key, {})
+        if credentials is None:
+            credentials = stored.get('credentials')
+        self.name = stored.get('name')
+        self.guid = stored.get('guid')
         self.camera_snapshot_uri = None
+        self._camera_uri_cache: OrderedDict = OrderedDict()
+        # (content type, frame, digest) of the most recent frame read by the camera stream thread
+        self._latest_frame = None
+        self._latest_frame_lock = threading.Lock()
+        self._camera_stream_thread = None
+        self._camera_stream_stop = threading.Event()
+        # One keep-alive pool per printer, large enough for the concurrent requests of into_ultimaker_json_async
+        self._session = _TimeoutSession(lambda: (self.connect_timeout, self.timeout))
+        self._session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+        self._digest_auth = None
+        self.set_credentials(credentials)
+        # Long-lived workers for into_ultimaker_json_async. HTTPDigestAuth keeps its nonce per thread, so reusing
+        # the same threads across polls avoids a 401 challenge on every request.
+        self._executor = ThreadPoolExecutor(
+            max_workers=_CONCURRENT_REQUESTS_PER_PRINTER, thread_name_prefix=f'ultimaker-{address}')
+
+    # Stops the camera stream and releases the worker threads and connections. The printer can't be polled afterwards.
+    def close(self):
+        self.stop_camera_stream()
+        self._executor.shutdown()
+        self._session.close()
 
     def acquire_credentials(self):
         credentials_json = self.post_auth_request()
         self.set_credentials(Credentials(**credentials_json))
 
+    # Credentials aren't verified up front. If the printer no longer knows them, _authed_request sees a 401 and
+    # acquires new ones.
     def get_credentials(self) -> Credentials:
         if self.credentials is None:
             self.acquire_credentials()
-        elif not self.get_auth_verify():
-            self.credentials = None
-            self.acquire_credentials()
         return self.credentials
 
     def set_credentials(self, credentials: Credentials):
         self.credentials = credentials
+        # The same HTTPDigestAuth is reused so its nonce state carries over between requests
+        self._digest_auth = None if credentials is None else HTTPDigestAuth(credentials.id, credentials.key)
+        self._update_store(credentials=credentials)
+
+    def _update_store(self, **values):
+        if self._store is None:
+            return
+        with _STORE_LOCK:
+            entry = dict(self._store.get(self._store_key, {}))
+            if all(entry.get(key) == value for key, value in values.items()):
+                return
+            entry.update(values)
+            self._store[self._store_key] = entry
+            self._store.sync()
 
     def digest_auth(self) -> HTTPDigestAuth:
-        credentials = self.get_credentials()
-        return HTTPDigestAuth(credentials.id, credentials.key)
+        self.get_credentials()
+        return self._digest_auth
 
     def is_authorized(self) -> bool:
         self.get_credentials()
         return self.get_auth_check() == 'authorized'
 
     def into_ultimaker_json(self) -> Dict[str, str]:
+        return asyncio.run(self.into_ultimaker_json_async())
+
+    # Blocking requests run in executor, or in the printer's own worker threads if none is given
+    async def into_ultimaker_json_async(self, executor: Executor = None) -> Dict[str, str]:
+        if executor is None:
+            executor = self._executor
         try:
-            status = self.get_printer_status()
+            # The status, name and snapshot endpoints are independent, so their round trips are overlapped
+            status, name, snapshot = await asyncio.gather(
+                self._run_blocking(executor, self.get_printer_status),
+                self._run_blocking(executor, self.get_system_name),
+                self._run_blocking(executor, self.get_camera_snapshot_uri))
             ultimaker_json = {
                 'system': {
-                    'name': self.get_system_name(),
+                    'name': name,
                 },
                 'printer': {
                     'status': status,
                 },
                 'camera': {
-                    'snapshot': self.get_camera_snapshot_uri()
+                    'snapshot': snapshot
                 }
             }
             if status == 'printing':
-                print_job: PrintJob = self.get_print_job()
+                print_job: PrintJob = await self._run_blocking(executor, self.get_print_job)
                 ultimaker_json['print_job'] = print_job.as_str_dict()
             return ultimaker_json
         except requests.exceptions.Timeout:
@@ -159,72 +373,152 @@ class Printer():
             print(f'Exception while generating ultimaker json {e}')
             raise
 
+    # Runs a blocking request function in an executor so several can be in flight at once
+    async def _run_blocking(self, executor: Executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+
     # All of the request functions below are from the Ultimaker Swagger Api available at http://PRINTER_ADDRESS/docs/api/
     # You can usually only call things other than /auth/check and /auth/request when you have credentials. As far as I've
     # tested, you don't need credentials for get queries. To be on the safe side, credentials are requested.
     # -------------------------------------------------------------------------------------------------------------------
 
+    # Sends a request with digest auth. A 401 means the printer doesn't know the credentials (they may not be if
+    # the printer was reset), so new ones are acquired and the request is retried once.
+    def _authed_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        res: requests.Response = self._session.request(method, url, auth=self.digest_auth(), **kwargs)
+        if res.status_code == 401:
+            self.set_credentials(None)
+            self.acquire_credentials()
+            res = self._session.request(method, url, auth=self._digest_auth, **kwargs)
+        return res
+
     def post_auth_request(self) -> Dict:
-        return requests.post(url=f"http://{self.host}/api/v1/auth/request", data={'application': self.identity.application, 'user': self.identity.user}, timeout=self.timeout).json()
+        return _json(self._session.post(url=self._urls['auth_request'], data={'application': self.identity.application, 'user': self.identity.user}))
 
     # Returns the response from an authorization check
     def get_auth_check(self) -> str:
-        return requests.get(url=f"http://{self.host}/api/v1/auth/check/{self.credentials.id}", timeout=self.timeout).json()['message']
+        return _json(self._session.get(url=self._urls['auth_check'] + self.credentials.id))['message']
 
     # Returns whether the credentials are known to the printer. They may not be if the printer was reset.
     # Note that this is completely different from get_auth_check.
     def get_auth_verify(self) -> bool:
-        return requests.get(
-            url=f"http://{self.host}/api/v1/auth/verify", auth=HTTPDigestAuth(self.credentials.id, self.credentials.key), timeout=self.timeout).status_code != 401
+        return self._session.get(
+            url=self._urls['auth_verify'], auth=self._digest_auth).status_code != 401
 
     def get_printer_status(self) -> str:
-        return requests.get(
-            url=f"http://{self.host}/api/v1/printer/status", auth=self.digest_auth(), timeout=self.timeout).json()
+        return _json(self._authed_request('GET', self._urls['printer_status']))
 
     def get_print_job(self) -> PrintJob:
-        print_job_dict: Dict = requests.get(url=f"http://{self.host}/api/v1/print_job", auth=self.digest_auth(), timeout=self.timeout).json()
-        return PrintJob.parse(print_job_dict)
+        return PrintJob.parse(_json(self._authed_request('GET', self._urls['print_job'])))
 
     def get_print_job_state(self) -> str:
-        return requests.get(
-            url=f"http://{self.host}/api/v1/print_job/state", auth=self.digest_auth(), timeout=self.timeout).json()
+        return _json(self._authed_request('GET', self._urls['print_job_state']))
 
     def get_print_job_time_elapsed(self) -> datetime.timedelta:
-        return datetime.timedelta(seconds=requests.get(
-            url=f"http://{self.host}/api/v1/print_job/time_elapsed", auth=self.digest_auth(), timeout=self.timeout).json())
+        return datetime.timedelta(seconds=_json(self._authed_request('GET', self._urls['print_job_time_elapsed'])))
 
     def get_print_job_time_total(self) -> datetime.timedelta:
-        return datetime.timedelta(seconds=requests.get(
-            url=f"http://{self.host}/api/v1/print_job/time_total", auth=self.digest_auth(), timeout=self.timeout).json())
+        return datetime.timedelta(seconds=_json(self._authed_request('GET', self._urls['print_job_time_total'])))
 
     def get_print_job_progress(self) -> float:
-        return requests.get(
-            url=f"http://{self.host}/api/v1/print_job/progress", auth=self.digest_auth(), timeout=self.timeout).json()
+        return _json(self._authed_request('GET', self._urls['print_job_progress']))
 
     def get_print_job_name(self) -> str:
-        return requests.get(
-            url=f"http://{self.host}/api/v1/print_job/name", auth=self.digest_auth(), timeout=self.timeout).json()
+        return _json(self._authed_request('GET', self._urls['print_job_name']))
 
     def put_system_display_message(self, message: str, button_caption: str) -> str:
-        return requests.put(url=f"http://{self.host}/api/v1/system/display_message", auth=self.digest_auth(), json={'message': message, 'button_caption': button_caption}, timeout=self.timeout).json()
+        return _json(self._authed_request('PUT', self._urls['system_display_message'], json={'message': message, 'button_caption': button_caption}))
 
     # Frequency in Hz, duration in ms
     def put_beep(self, frequency: float, duration: float) -> str:
-        return requests.put(url=f"http://{self.host}/api/v1/beep", auth=self.digest_auth(), json={'frequency': frequency, 'duration': duration}, timeout=self.timeout).json()
+        return _json(self._authed_request('PUT', self._urls['beep'], json={'frequency': frequency, 'duration': duration}))
 
     def get_system_guid(self) -> UUID:
         if self.guid is None:
-            self.guid = UUID(requests.get(url=f'http://{self.host}/api/v1/system/guid', timeout=self.timeout).json())
+            self.guid = UUID(_json(self._session.get(url=self._urls['system_guid'])))
+            self._update_store(guid=self.guid)
         return self.guid
 
     def get_system_name(self) -> str:
-        self.name = requests.get(url=f'http://{self.host}/api/v1/system/name', timeout=self.timeout).json()
+        if self.name is None:
+            self.name = _json(self._session.get(url=self._urls['system_name']))
+            self._update_store(name=self.name)
         return self.name
 
+    # Keeps a single connection to the camera's MJPEG stream open in a background thread so that
+    # get_camera_snapshot_uri can use the latest frame instead of requesting a new snapshot every time
+    def start_camera_stream(self):
+        if self._camera_stream_thread is not None and self._camera_stream_thread.is_alive():
+            return
+        self._camera_stream_stop.clear()
+        self._camera_stream_thread = threading.Thread(target=self._read_camera_stream, daemon=True)
+        self._camera_stream_thread.start()
+
+    def stop_camera_stream(self):
+        self._camera_stream_stop.set()
+        if self._camera_stream_thread is not None:
+            self._camera_stream_thread.join()
+            self._camera_stream_thread = None
+        with self._latest_frame_lock:
+            self._latest_frame = None
+
+    def _read_camera_stream(self):
+        while not self._camera_stream_stop.is_set():
+            try:
+                with self._session.get(url=self._urls['camera_stream'], stream=True) as res:
+                    res.raise_for_status()
+                    _, _, boundary = res.headers['Content-Type'].partition('boundary=')
+                    frames = _mjpeg_frames(_available_chunks(res.raw), boundary.strip('"').encode('ascii'))
+                    for content_type, frame in frames:
+                        latest_frame = (content_type, frame, _snapshot_digest(frame))
+                        with self._latest_frame_lock:
+                            self._latest_frame = latest_frame
+                        if self._camera_stream_stop.is_set():
+                            return
+            # Reading res.raw directly raises urllib3's exceptions (e.g. ReadTimeoutError) rather than requests' own
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, KeyError, ValueError) as e:
+                print(f'Exception while reading camera stream {e}')
+            finally:
+                # Whatever ended the stream, get_camera_frame must fall back to snapshots instead of a stale frame
+                with self._latest_frame_lock:
+                    self._latest_frame = None
+            self._camera_stream_stop.wait(CAMERA_STREAM_RETRY_INTERVAL)
+
+    # Returns (content type, frame, digest) from the camera stream if it is running, otherwise from a snapshot request
+    def get_camera_frame(self) -> Tuple[str, bytes, bytes]:
+        with self._latest_frame_lock:
+            latest_frame = self._latest_frame
+        if latest_frame is not None:
+            return latest_frame
+        res: requests.Response = self._session.get(url=self._urls['camera_snapshot'], stream=True)
+        content = bytearray()
+        blake2b = hashlib.blake2b(digest_size=16)
+        for chunk in res.iter_content(chunk_size=SNAPSHOT_CHUNK_SIZE):
+            blake2b.update(chunk)
+            content += chunk
+        return res.headers['Content-Type'], bytes(content), blake2b.digest()
+
+    # camera_snapshot_uri holds (uri, content digest) of the last encoded frame
     def get_camera_snapshot_uri(self) -> str:
-        res: requests.Response = requests.get(url=f'http://{self.address}:8080/?action=snapshot', timeout=self.timeout)
-        image: Image = Image.open(io.BytesIO(res.content))
-        hash: imagehash.ImageHash = imagehash.phash(image)
-        if self.camera_snapshot_uri is None or hash != self.camera_snapshot_uri[1]:
-            self.camera_snapshot_uri = (f"data:{res.headers['Content-Type']};base64,{base64.b64encode(res.content).decode('utf-8')}", hash)
+        content_type, content, digest = self.get_camera_frame()
+        if self.camera_snapshot_uri is None or digest != self.camera_snapshot_uri[1]:
+            uri = self._camera_uri_cache.get(digest)
+            if uri is not None:
+                # The camera often flips between a handful of frames, which don't need to be encoded again
+                self._camera_uri_cache.move_to_end(digest)
+            else:
+                uri = data_uri(content_type, content)
+                self._camera_uri_cache[digest] = uri
+                if len(self._camera_uri_cache) > CAMERA_URI_CACHE_SIZE:
+                    self._camera_uri_cache.popitem(last=False)
+            self.camera_snapshot_uri = (uri, digest)
         return self.camera_snapshot_uri[0]
+
+
+# Polls all printers concurrently, so the total latency is that of the slowest printer rather than the sum.
+# A printer that fails has its exception in its place in the result instead of failing the whole batch.
+# Each printer runs its requests in its own worker threads unless a shared executor is given.
+async def gather_ultimaker_jsons(printers: List[Printer], executor: Executor = None) -> List[Union[Dict[str, str], BaseException]]:
+    return await asyncio.gather(
+        *(printer.into_ultimaker_json_async(executor) for printer in printers), return_exceptions=True)